@@ -1,27 +1,55 @@
 import chess
 import chess.pgn
 import chess.engine
+import chess.polyglot
 import json
 import os
 import time
 import datetime
+import io
+import mmap
+import multiprocessing
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import orjson  # Быстрая сериализация JSON (pip install orjson), необязательно
+except ImportError:
+    orjson = None
 
 # --- НАСТРОЙКИ ---
 
 # Файл с партиями
 INPUT_PGN_FILE = "games.pgn" # Или "mega2026_11.pgn"
+OUTPUT_NDJSON_FILE = "puzzles.ndjson" # Задачи пишутся сюда по одной строке сразу после нахождения
+OUTPUT_JSON_FILE = "puzzles.json"     # Итоговый файл для тренажера
 STOCKFISH_PATH = "stockfish-windows-x86-64-avx2.exe" # <-- УКАЖИТЕ ПУТЬ К ДВИЖКУ
 
 # Настройки генератора
 MAX_PUZZLES = 1000        # Сколько задач собрать
 MIN_PIECES = 12           # <--- ИЗМЕНЕНО: Минимум 12 фигур на доске
+MIN_PLY = 10              # С какого полухода начинаем искать задачи (пропускаем дебют)
+MIN_ELO = 0               # Минимальный рейтинг обоих игроков (0 = без фильтра)
 ENGINE_DEPTH = 12         # Глубина анализа Stockfish
+SCREEN_DEPTH = 10         # Глубина быстрой предварительной оценки хода
+SCREEN_MARGIN = 200       # Насколько быстрая оценка должна быть далека от порогов, чтобы ей поверить
 BAD_MOVE_THRESHOLD = 120  # Порог ошибки (1.2 пешки)
 WINNING_SCORE = 150       # Порог выигрыша
 STRICT_WIN_CHECK = True   # Строго следить за упущенной победой
 
+# Настройки параллельности
+PGN_WORKERS = 2           # Сколько процессов разбирают партии (у каждого свой пул движков)
+GAMES_PER_CHUNK = 20      # Сколько партий процесс берет за одно задание
+PROGRESS_EVERY = 100      # Как часто процесс сообщает о числе проанализированных позиций
+
+# Настройки движков
+ENGINE_WORKERS = max(1, (os.cpu_count() or 1) // PGN_WORKERS)  # Однопоточных Stockfish на процесс
+ENGINE_HASH_MB = 128      # Хэш на каждый экземпляр движка
+SCORE_CACHE_SIZE = 200000 # Сколько оценок позиций помнить между партиями
+
 # Настройки отбора (как в старом файле)
 MIN_TOTAL_TARGETS = 4     # Минимум целей (Good + Bad), чтобы сохранить задачу
+MAX_TOTAL_TARGETS = 20    # Позиции с большим числом целей не анализируем (0 = без ограничения)
 
 # ----------------------------
 
@@ -36,79 +64,457 @@ def determine_difficulty(total_targets):
     else:
         return "hard"
 
+class StrictVisitor(chess.pgn.BaseVisitor):
+    """
+    Разбирает партию ровно настолько, насколько нужно генератору.
+    Пропускает партии слабее MIN_ELO и все варианты, а ходы после того,
+    как на доске осталось меньше MIN_PIECES фигур, даже не разбирает
+    (число фигур по ходу партии не растет).
+    Результат — список (board, ply) позиций-кандидатов.
+    """
+
+    def begin_game(self):
+        self.positions = []
+        self.elos = {}
+        self.ply = -1
+        self.done = False
+
+    def visit_header(self, tagname, tagvalue):
+        if tagname in ("WhiteElo", "BlackElo"):
+            self.elos[tagname] = tagvalue
+
+    def end_headers(self):
+        if MIN_ELO <= 0:
+            return None
+        try:
+            if min(int(self.elos["WhiteElo"]), int(self.elos["BlackElo"])) >= MIN_ELO:
+                return None
+        except (KeyError, ValueError):
+            pass
+        return chess.pgn.SKIP
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def begin_parse_san(self, board, san):
+        if self.done:
+            return chess.pgn.SKIP
+        return None
+
+    def visit_board(self, board):
+        # Вызывается для начальной позиции и после каждого хода
+        if self.done:
+            return
+        self.ply += 1
+        if chess.popcount(board.occupied) < MIN_PIECES:
+            self.done = True
+            return
+        if self.ply >= MIN_PLY:
+            self.positions.append((board.copy(stack=False), self.ply))
+
+    def handle_error(self, error):
+        # Битый ход: берем то, что успели собрать, остаток партии пропускаем
+        self.done = True
+
+    def result(self):
+        return self.positions
+
 def count_games_in_pgn(file_path):
     print("📊 Подсчет общего количества партий...", end="\r")
     count = 0
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            for line in f:
-                if line.startswith("[Event "): count += 1
+        # Считаем "\n[Event " блоками по 16 МБ прямо в байтах, без построчного разбора.
+        # Блоки перекрываются на 7 байт, чтобы не потерять метку на границе.
+        block = 1 << 24
+        with open(file_path, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                count = 1 if mm[:7] == b"[Event " else 0
+                for start in range(0, len(mm), block):
+                    count += mm[start:start + block + 7].count(b"\n[Event ")
     except: pass
     print(f"📊 Всего партий в файле: {count}            ")
     return count
 
-def get_engine_score(board, engine, depth):
-    info = engine.analyse(board, chess.engine.Limit(depth=depth))
-    score = info["score"].relative
+def iter_pgn_chunks(file_path):
+    """
+    Делит PGN-файл на куски по GAMES_PER_CHUNK партий (границы — строки "[Event ").
+    Возвращает диапазоны байтов (start, end): сами данные читает процесс-обработчик.
+    """
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            games = 0
+            pos = mm.find(b"\n[Event ")
+            while pos != -1:
+                games += 1
+                if games >= GAMES_PER_CHUNK:
+                    yield start, pos + 1
+                    start = pos + 1
+                    games = 0
+                pos = mm.find(b"\n[Event ", pos + 1)
+            if start < len(mm):
+                yield start, len(mm)
+
+# Пул движков: у каждого потока свой однопоточный Stockfish.
+# Движки живут, пока жив процесс: когда процесс завершается, у Stockfish
+# закрывается stdin, и он выходит сам.
+engine_local = threading.local()
+
+def open_engine():
+    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+    try:
+        engine.configure({"Threads": 1, "Hash": ENGINE_HASH_MB})
+    except Exception:
+        engine.quit()
+        raise
+    return engine
+
+def get_thread_engine():
+    """
+    Возвращает движок текущего потока пула (запускает его при первом обращении).
+    """
+    engine = getattr(engine_local, "engine", None)
+    if engine is None:
+        engine = open_engine()
+        engine_local.engine = engine
+    return engine
+
+def score_move(fen, base_score):
+    """
+    Задача для пула: оценка хода (fen — позиция после хода) с точки зрения
+    сходившей стороны. Сначала быстрая оценка на SCREEN_DEPTH; полный анализ
+    на ENGINE_DEPTH только если она близка к порогам классификации.
+    """
+    board = chess.Board(fen)
+    engine = get_thread_engine()
+    move_score = -get_engine_score(board, engine, depth=SCREEN_DEPTH)
+    if is_borderline_move(base_score, move_score):
+        move_score = -get_engine_score(board, engine, depth=ENGINE_DEPTH)
+    return move_score
+
+# Кэш оценок: (zobrist-ключ позиции, глубина) -> оценка.
+# Живет весь запуск, поэтому ловит транспозиции между партиями.
+score_cache = {}
+score_cache_lock = threading.Lock()
+
+def score_to_value(score):
+    """
+    Оценка движка (PovScore) в сантипешках с точки зрения стороны, чей ход; мат — ±10000.
+    """
+    score = score.relative
     if score.is_mate():
         return 10000 if score.mate() > 0 else -10000
     return score.score()
 
-def format_time(seconds):
-    return str(datetime.timedelta(seconds=int(seconds)))
+def store_score(key, value):
+    with score_cache_lock:
+        # Вытесняем самые старые записи (dict хранит порядок вставки)
+        if len(score_cache) >= SCORE_CACHE_SIZE:
+            del score_cache[next(iter(score_cache))]
+        score_cache[key] = value
+    return value
+
+def get_engine_score(board, engine, depth):
+    key = (chess.polyglot.zobrist_hash(board), depth)
+    with score_cache_lock:
+        cached = score_cache.get(key)
+    if cached is not None:
+        return cached
 
-def analyze_position_for_side(board, engine):
+    info = engine.analyse(board, chess.engine.Limit(depth=depth))
+    return store_score(key, score_to_value(info["score"]))
+
+def start_engine_score(board, engine, depth):
     """
-    Ищет ходы (шахи и взятия) для стороны, чей сейчас ход на доске.
-    Возвращает два списка: good_moves_san, bad_moves_san.
+    Запускает оценку позиции и не ждет результата: пока движок считает,
+    Python занимается другой работой. Возвращает функцию, которая дожидается
+    оценки (как у get_engine_score, с тем же кэшем).
     """
-    legal_moves = list(board.legal_moves)
+    key = (chess.polyglot.zobrist_hash(board), depth)
+    with score_cache_lock:
+        cached = score_cache.get(key)
+    if cached is not None:
+        return lambda: cached
+
+    analysis = engine.analysis(board, chess.engine.Limit(depth=depth))
+
+    def wait():
+        with analysis:
+            analysis.wait()
+        return store_score(key, score_to_value(analysis.info["score"]))
+
+    return wait
+
+def get_target_moves(board):
+    """
+    Ходы-кандидаты (шахи и взятия) для стороны, чей сейчас ход на доске.
+    Взятия и возможные шахи отбираются битбордами, а дорогой gives_check
+    (ход + откат) вызывается только для ходов, которые могут дать шах.
+    """
+    us = board.turn
+    enemy = board.occupied_co[not us]
+    king_sq = board.king(not us)
+
+    if king_sq is None:
+        check_squares = {}
+        discoverers = 0
+    else:
+        # Поля, с которых фигура каждого типа бьет короля противника
+        occupied = board.occupied
+        diag = chess.BB_DIAG_ATTACKS[king_sq][chess.BB_DIAG_MASKS[king_sq] & occupied]
+        ortho = (chess.BB_RANK_ATTACKS[king_sq][chess.BB_RANK_MASKS[king_sq] & occupied] |
+                 chess.BB_FILE_ATTACKS[king_sq][chess.BB_FILE_MASKS[king_sq] & occupied])
+        check_squares = {
+            chess.PAWN: chess.BB_PAWN_ATTACKS[not us][king_sq],
+            chess.KNIGHT: chess.BB_KNIGHT_ATTACKS[king_sq],
+            chess.BISHOP: diag,
+            chess.ROOK: ortho,
+            chess.QUEEN: diag | ortho,
+        }
+
+        # Наши фигуры, единственные между королем противника и нашей дальнобойной
+        # фигурой: их уход может дать вскрытый шах
+        snipers = (((chess.BB_RANK_ATTACKS[king_sq][0] | chess.BB_FILE_ATTACKS[king_sq][0]) & (board.rooks | board.queens)) |
+                   (chess.BB_DIAG_ATTACKS[king_sq][0] & (board.bishops | board.queens))) & board.occupied_co[us]
+        discoverers = 0
+        for sniper in chess.scan_reversed(snipers):
+            blockers = chess.between(king_sq, sniper) & occupied
+            if chess.popcount(blockers) == 1:
+                discoverers |= blockers & board.occupied_co[us]
+
     targets = []
-    
-    # 1. Отбираем кандидатов (шах или взятие)
-    for m in legal_moves:
-        if board.is_capture(m) or board.gives_check(m):
+    for m in board.legal_moves:
+        # Взятие: на поле назначения фигура противника (или взятие на проходе)
+        if chess.BB_SQUARES[m.to_square] & enemy or (m.to_square == board.ep_square and board.is_en_passant(m)):
+            targets.append(m)
+            continue
+
+        if king_sq is None:
+            continue
+
+        # Шах: прямой, вскрытый, через превращение или рокировку — подтверждаем gives_check
+        piece_type = board.piece_type_at(m.from_square)
+        if piece_type == chess.KING:
+            maybe_check = board.is_castling(m) or chess.BB_SQUARES[m.from_square] & discoverers
+        else:
+            maybe_check = (m.promotion or chess.BB_SQUARES[m.from_square] & discoverers or
+                           chess.BB_SQUARES[m.to_square] & check_squares[piece_type])
+        if maybe_check and board.gives_check(m):
             targets.append(m)
-    
-    if not targets:
-        return [], []
 
-    # 2. Оценка базовой позиции
-    base_score = get_engine_score(board, engine, depth=10)
-    
-    # Если позиция уже безнадежно проиграна (-3.0), не ищем ходы (экономим время)
-    if base_score < -300: 
-        return [], []
+    return targets
 
-    good = []
-    bad = []
+def is_bad_move(base_score, move_score):
+    """
+    Плохой ход: сильно ухудшает оценку или меняет исход (упустили победу / зевнули проигрыш).
+    """
+    # Критерий 1: Сильное ухудшение оценки (проверяем первым — дальше не считаем)
+    # Критерий 2: Смена статуса (упустили победу или зевнули проигрыш)
+    return (base_score - move_score > BAD_MOVE_THRESHOLD or
+            (STRICT_WIN_CHECK and
+             ((base_score >= WINNING_SCORE and move_score < WINNING_SCORE) or
+              (base_score > -50 and move_score < -150))))
+
+def is_borderline_move(base_score, move_score):
+    """
+    Оценка хода ближе SCREEN_MARGIN к одному из порогов is_bad_move —
+    неглубокому анализу такой классификации верить нельзя.
+    """
+    if abs(base_score - move_score - BAD_MOVE_THRESHOLD) < SCREEN_MARGIN:
+        return True
+    if STRICT_WIN_CHECK:
+        if base_score >= WINNING_SCORE and abs(move_score - WINNING_SCORE) < SCREEN_MARGIN:
+            return True
+        if base_score > -50 and abs(move_score + 150) < SCREEN_MARGIN:
+            return True
+    return False
+
+def dump_puzzle_line(puzzle):
+    """
+    Одна задача в виде строки NDJSON (байты).
+    """
+    if orjson is not None:
+        return orjson.dumps(puzzle) + b"\n"
+    return json.dumps(puzzle, ensure_ascii=False).encode("utf-8") + b"\n"
+
+def convert_ndjson_to_json(ndjson_path, json_path):
+    """
+    Собирает построчный NDJSON в итоговый JSON-массив.
+    Можно вызвать и вручную, если генерация была прервана.
+    """
+    with open(ndjson_path, "rb") as f:
+        puzzles = [json.loads(line) for line in f if line.strip()]
+
+    if orjson is not None:
+        with open(json_path, "wb") as f:
+            f.write(orjson.dumps(puzzles, option=orjson.OPT_INDENT_2))
+    else:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(puzzles, f, indent=2, ensure_ascii=False)
+    return len(puzzles)
 
+def format_time(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
+
+def analyze_position_for_side(board, executor, targets, base_score):
+    """
+    Классифицирует ходы-кандидаты targets стороны, чей сейчас ход на доске.
+    base_score — уже посчитанная оценка позиции; ходы оцениваются параллельно в пуле executor.
+    Возвращает два списка ходов (chess.Move): good, bad — SAN строится только
+    для сохраняемых задач.
+    """
+    # Оцениваем все ходы-кандидаты параллельно (с быстрым отсевом очевидных)
+    futures = {}
     for m in targets:
         board.push(m)
-        move_score = -get_engine_score(board, engine, depth=ENGINE_DEPTH)
+        futures[executor.submit(score_move, board.fen(), base_score)] = m
         board.pop()
 
-        san = board.san(m)
-        diff = base_score - move_score 
-        
-        is_bad = False
+    move_scores = {}
+    for future in as_completed(futures):
+        move_scores[futures[future]] = future.result()
 
-        # Критерий 1: Сильное ухудшение оценки
-        if diff > BAD_MOVE_THRESHOLD: 
-            is_bad = True
-        
-        # Критерий 2: Смена статуса (упустили победу или зевнули проигрыш)
-        if STRICT_WIN_CHECK:
-            if base_score >= WINNING_SCORE and move_score < WINNING_SCORE and move_score < 9000:
-                is_bad = True
-            if base_score > -50 and move_score < -150:
-                is_bad = True
-
-        if is_bad: bad.append(san)
-        else: good.append(san)
+    good = []
+    bad = []
+
+    for m in targets:
+        if is_bad_move(base_score, move_scores[m]): bad.append(m)
+        else: good.append(m)
         
     return good, bad
 
+# Состояние процесса-обработчика (заполняет init_worker)
+worker_engine = None
+worker_executor = None
+worker_side_executor = None
+worker_pgn = None
+worker_seen_keys = set()
+worker_positions = 0
+
+def init_worker():
+    global worker_engine, worker_executor, worker_side_executor, worker_pgn
+    worker_engine = open_engine()
+    worker_executor = ThreadPoolExecutor(max_workers=ENGINE_WORKERS)
+    # Отдельный пул для двух сторон позиции: их потоки только ждут задачи
+    # из worker_executor, поэтому общий пул использовать нельзя (взаимоблокировка)
+    worker_side_executor = ThreadPoolExecutor(max_workers=2)
+    worker_pgn = open(INPUT_PGN_FILE, "rb")
+
+def analyze_position(board):
+    """
+    Анализирует позицию за обе стороны.
+    Возвращает задачу (без id) или None, если позиция не подходит.
+    """
+    # Анализируем за текущую сторону и за обратную (переворачиваем ход).
+    # Позиция из партии корректна, поэтому вместо полного is_valid() достаточно
+    # одной проверки: ход нельзя передать, если король ходящей стороны под шахом
+    side_boards = [board]
+    if not board.is_attacked_by(not board.turn, board.king(board.turn)):
+        board_flipped = board.copy(stack=False)
+        board_flipped.turn = not board.turn
+        board_flipped.ep_square = None
+        side_boards.append(board_flipped)
+
+    # 1. Отбираем кандидатов (шах или взятие)
+    sides = []
+    for side_board in side_boards:
+        targets = get_target_moves(side_board)
+        if targets:
+            sides.append((side_board, targets))
+
+    # Ранний выход до движка. Обрезать анализ на полпути нельзя: тренажер
+    # сверяется со списком плохих ходов, он должен быть полным. Поэтому
+    # отсекаем целиком позиции, где целей заведомо мало или слишком много
+    # (самые дорогие, а сложность "hard" дают и позиции с 15–20 целями)
+    candidates = sum(len(targets) for _, targets in sides)
+    if candidates < MIN_TOTAL_TARGETS:
+        return None
+    if MAX_TOTAL_TARGETS and candidates > MAX_TOTAL_TARGETS:
+        return None
+
+    # 2. Оценка базовой позиции — один раз на сторону, до анализа ходов.
+    # Оценку следующей стороны запускаем заранее: движок процесса считает ее,
+    # пока пул разбирает ходы текущей стороны
+    side_futures = []
+    base_job = start_engine_score(sides[0][0], worker_engine, depth=10) if sides else None
+    for i, (side_board, targets) in enumerate(sides):
+        base_score = base_job()
+        if i + 1 < len(sides):
+            base_job = start_engine_score(sides[i + 1][0], worker_engine, depth=10)
+
+        # Если позиция уже безнадежно проиграна (-3.0), не ищем ходы (экономим время)
+        if base_score < -300: continue
+
+        # 3. Классифицируем ходы — обе стороны одновременно, их ходы делят пул движков
+        future = worker_side_executor.submit(analyze_position_for_side, side_board, worker_executor, targets, base_score)
+        side_futures.append((side_board, future))
+
+    all_good = []  # (доска стороны, ход): SAN строим только для сохраняемой задачи
+    all_bad = []
+    for side_board, future in side_futures:
+        good, bad = future.result()
+        all_good += [(side_board, m) for m in good]
+        all_bad += [(side_board, m) for m in bad]
+
+    total_targets = len(all_good) + len(all_bad)
+
+    # === ФИЛЬТРАЦИЯ ===
+    
+    # 1. Должен быть хотя бы 1 хороший ход (иначе задача нерешаемая/скучная)
+    # 2. Общее число целей должно быть >= MIN_TOTAL_TARGETS (как в старом файле)
+    if len(all_good) == 0 or total_targets < MIN_TOTAL_TARGETS:
+        return None
+
+    return {
+        "fen": board.fen(),
+        "difficulty": determine_difficulty(total_targets),
+        "good_moves": [side_board.san(m) for side_board, m in all_good],
+        "bad_moves": [side_board.san(m) for side_board, m in all_bad]
+    }
+
+def process_chunk(chunk):
+    """
+    Задача для процесса-обработчика: разбирает партии из диапазона байтов
+    PGN-файла и анализирует их позиции.
+    Возвращает (число партий, [(zobrist-ключ, задача), ...]).
+    """
+    global worker_positions
+    start, end = chunk
+    worker_pgn.seek(start)
+    pgn = io.StringIO(worker_pgn.read(end - start).decode("utf-8", errors="replace"))
+
+    games = 0
+    found = []
+    while True:
+        # Дебют, малое число фигур и рейтинг отсекает StrictVisitor
+        try:
+            positions = chess.pgn.read_game(pgn, Visitor=StrictVisitor)
+        except Exception:
+            continue # Если партия битая, пропускаем
+            
+        if positions is None: break
+        games += 1
+
+        for board, _ in positions:
+            # Уже найденную позицию не анализируем повторно
+            # (zobrist не учитывает счетчики ходов — для тактики это то, что нужно)
+            position_key = chess.polyglot.zobrist_hash(board)
+            if position_key in worker_seen_keys: continue
+
+            puzzle = analyze_position(board)
+
+            worker_positions += 1
+            if worker_positions % PROGRESS_EVERY == 0:
+                print(f"   ↳ [{os.getpid()}] Проанализировано позиций: {worker_positions}")
+
+            if puzzle is not None:
+                worker_seen_keys.add(position_key)
+                found.append((position_key, puzzle))
+
+    return games, found
+
 def generate():
     if not os.path.exists(STOCKFISH_PATH):
         print(f"❌ Ошибка: Не найден Stockfish: {STOCKFISH_PATH}")
@@ -117,112 +523,68 @@ def generate():
         print(f"❌ Ошибка: Не найден PGN файл: {INPUT_PGN_FILE}")
         return
 
-    puzzles = []
+    saved = 0
+    seen_keys = set()
     stats = {"easy": 0, "medium": 0, "hard": 0}
 
     total_games = count_games_in_pgn(INPUT_PGN_FILE)
 
     print(f"🚀 Генератор запущен (Умный анализ + Жесткий отбор)")
     print(f"🎯 Цель: {MAX_PUZZLES} задач")
-    print(f"⚙️ Мин. целей: {MIN_TOTAL_TARGETS} | Мин. фигур: {MIN_PIECES}")
+    print(f"⚙️ Целей: {MIN_TOTAL_TARGETS}–{MAX_TOTAL_TARGETS or '∞'} | Мин. фигур: {MIN_PIECES}")
+    print(f"🧵 Процессов: {PGN_WORKERS} | Движков на процесс: {ENGINE_WORKERS}")
     print("-" * 60)
 
+    # Проверяем движок заранее: ошибка в процессах-обработчиках менее понятна
     try:
-        engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+        open_engine().quit()
     except Exception as e:
         print(f"❌ Ошибка запуска движка: {e}")
         return
 
-    pgn = open(INPUT_PGN_FILE, encoding="utf-8")
     games_processed = 0
     start_time = time.time()
-    
-    while len(puzzles) < MAX_PUZZLES:
-        # Читаем партию с обработкой ошибок
-        try:
-            game = chess.pgn.read_game(pgn)
-        except Exception:
-            continue # Если партия битая, пропускаем
-            
-        if game is None: break
-
-        board = game.board()
-        games_processed += 1
-        
-        print(f"\n♟️ Партия {games_processed}/{total_games}")
-
-        move_count = 0
-        for move in game.mainline_moves():
-            board.push(move)
-            move_count += 1
-            
-            # Пропускаем дебют и позиции с малым числом фигур
-            if move_count < 10: continue
-            
-            # === ФИЛЬТР ПО КОЛИЧЕСТВУ ФИГУР ===
-            if len(board.piece_map()) < MIN_PIECES: continue
 
-            # === АНАЛИЗ ЗА ОБЕ СТОРОНЫ ===
-            
-            # 1. За текущую сторону
-            g1, b1 = analyze_position_for_side(board, engine)
-
-            # 2. За обратную сторону (переворачиваем ход)
-            fen_parts = board.fen().split(' ')
-            fen_parts[1] = 'w' if fen_parts[1] == 'b' else 'b'
-            fen_parts[3] = '-' 
-            board_flipped = chess.Board(" ".join(fen_parts))
-            
-            if board_flipped.is_valid():
-                g2, b2 = analyze_position_for_side(board_flipped, engine)
-            else:
-                g2, b2 = [], []
-
-            # Объединяем
-            all_good = g1 + g2
-            all_bad = b1 + b2
-            total_targets = len(all_good) + len(all_bad)
-
-            print(f"   ↳ Ход {move_count}: Целей {total_targets} (Good:{len(all_good)} Bad:{len(all_bad)})... ", end="", flush=True)
-
-            # === ФИЛЬТРАЦИЯ И СОХРАНЕНИЕ ===
-            
-            # 1. Должен быть хотя бы 1 хороший ход (иначе задача нерешаемая/скучная)
-            # 2. Общее число целей должно быть >= MIN_TOTAL_TARGETS (как в старом файле)
-            # 3. Убираем дубликаты (по FEN)
-            if len(all_good) > 0 and total_targets >= MIN_TOTAL_TARGETS:
-                if not any(p['fen'] == board.fen() for p in puzzles):
-                    
-                    difficulty = determine_difficulty(total_targets)
-                    stats[difficulty] += 1
-                    
-                    print(f"✅ [{difficulty.upper()}]")
-                    
-                    puzzles.append({
-                        "id": len(puzzles) + 1,  # Уникальный ID задачи
-                        "fen": board.fen(),
-                        "difficulty": difficulty,
-                        "good_moves": all_good,
-                        "bad_moves": all_bad
-                    })
-                    
-                    # Статистика времени
-                    elapsed = time.time() - start_time
-                    avg = elapsed / len(puzzles)
-                    rem = MAX_PUZZLES - len(puzzles)
-                    print(f"      [Итого: {len(puzzles)}/{MAX_PUZZLES}] [ETA: {format_time(avg * rem)}]")
-
-                    if len(puzzles) >= MAX_PUZZLES: break
-            else:
-                print(f"❌", end="\r")
-
-    engine.quit()
+    # Каждая задача сразу дописывается в NDJSON: при сбое найденное не теряется.
+    # При выходе из with пул завершает процессы-обработчики (и их движки)
+    with multiprocessing.Pool(processes=PGN_WORKERS, initializer=init_worker) as pool, \
+         open(OUTPUT_NDJSON_FILE, "wb") as out:
+        for games, found in pool.imap_unordered(process_chunk, iter_pgn_chunks(INPUT_PGN_FILE)):
+            games_processed += games
+            print(f"\n♟️ Партий обработано: {games_processed}/{total_games}")
+
+            # === СОХРАНЕНИЕ ===
+            # Дубликаты между процессами отсеиваем по zobrist-ключу
+            for position_key, puzzle in found:
+                if position_key in seen_keys: continue
+                seen_keys.add(position_key)
+
+                difficulty = puzzle["difficulty"]
+                stats[difficulty] += 1
+                
+                print(f"✅ [{difficulty.upper()}] {puzzle['fen']}")
+                
+                saved += 1
+                out.write(dump_puzzle_line({
+                    "id": saved,  # Уникальный ID задачи
+                    **puzzle
+                }))
+                out.flush()
+                
+                # Статистика времени
+                elapsed = time.time() - start_time
+                avg = elapsed / saved
+                rem = MAX_PUZZLES - saved
+                print(f"      [Итого: {saved}/{MAX_PUZZLES}] [ETA: {format_time(avg * rem)}]")
+
+                if saved >= MAX_PUZZLES: break
+
+            if saved >= MAX_PUZZLES: break
     
-    with open("puzzles.json", "w", encoding="utf-8") as f:
-        json.dump(puzzles, f, indent=4, ensure_ascii=False)
+    convert_ndjson_to_json(OUTPUT_NDJSON_FILE, OUTPUT_JSON_FILE)
     
     total_time = time.time() - start_time
-    print(f"\n\n🎉 Готово! Сохранено {len(puzzles)} задач.")
+    print(f"\n\n🎉 Готово! Сохранено {saved} задач.")
     print(f"📊 Статистика сложности:")
     print(f"   🟢 Легкие (<=8):   {stats['easy']}")
     print(f"   🟡 Средние (<=14): {stats['medium']}")